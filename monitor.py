@@ -1,11 +1,12 @@
-import requests
+import asyncio
 import time
-from datetime import datetime
+from email.utils import parsedate_to_datetime
+import httpx
+import orjson
+from aiohttp import web
 import os
 import logging
 import sys
-import json
-from flask import Flask, request
 
 # Set up logging
 logging.basicConfig(
@@ -21,6 +22,26 @@ class TerraformingMarsMonitor:
         self.base_url = "https://terraforming-mars.herokuapp.com"
         self.game_id = os.environ.get('GAME_ID', 'gca44cdf55303')
         self.current_state = None
+        self.game_age = 0
+        self.undo_count = 0
+        self._etag = None
+        
+        # /api/waitingfor takes a participant ID, so we use the game's spectator ID once we know it
+        self._spectator_id = None
+        self.poll_interval = float(os.environ.get('POLL_INTERVAL', '5'))
+        
+        # Longest we will wait before retrying, whatever Retry-After asks for
+        self.max_retry_delay = 120
+        
+        # Recently validated game IDs -> monotonic expiry time
+        self._valid_games = {}
+        self.validation_ttl = 60
+        
+        # Webhook commands still being processed; asyncio only keeps weak references to tasks
+        self._webhook_tasks = set()
+        
+        # Notifications waiting for the next flush, per phone, deduplicated in order
+        self._pending = {}
         
         # WhatsApp credentials and verification
         self.whatsapp_token = os.environ.get('WHATSAPP_TOKEN')
@@ -38,80 +59,126 @@ class TerraformingMarsMonitor:
         # Create reverse lookup for phone numbers to player names
         self.phone_to_player = {phone: name for name, phone in self.player_phones.items() if phone}
         
+        # Configured phones, filtered once for every broadcast
+        self._active_phones = tuple(phone for phone in self.player_phones.values() if phone)
+        
         # Verify configuration
-        if not all([self.whatsapp_token, self.whatsapp_phone_id]):
+        if not (self.whatsapp_token and self.whatsapp_phone_id):
             logging.error("Missing required WhatsApp environment variables!")
             raise ValueError("Missing required WhatsApp environment variables!")
+        
+        self._wa_path = f"/{self.whatsapp_phone_id}/messages"
+        self._wa_headers = {
+            "Authorization": f"Bearer {self.whatsapp_token}",
+            "Content-Type": "application/json"
+        }
+        
+        # Graph API speaks HTTP/2, so concurrent sends multiplex onto one connection
+        self.wa_client = httpx.AsyncClient(
+            http2=True,
+            base_url="https://graph.facebook.com/v21.0",
+            headers=self._wa_headers,
+            limits=httpx.Limits(max_keepalive_connections=8),
+            timeout=10.0
+        )
+        
+        # Keep-alive connection pool for game server requests
+        self.game_client = httpx.AsyncClient(base_url=self.base_url, timeout=10.0)
 
-    def setup_webhook_server(self):
-        """Setup Flask server for webhook with verification"""
-        app = Flask(__name__)
-
-        @app.route('/webhook', methods=['GET'])
-        def verify_webhook():
-            """Handle webhook verification from WhatsApp"""
-            mode = request.args.get('hub.mode')
-            token = request.args.get('hub.verify_token')
-            challenge = request.args.get('hub.challenge')
-
-            logging.info(f"Received verification request - Mode: {mode}, Token: {token}")
-
-            if mode and token:
-                if mode == 'subscribe' and token == self.webhook_verify_token:
-                    logging.info("Webhook verified successfully!")
-                    return challenge, 200
-                else:
-                    logging.warning("Webhook verification failed")
-                    return 'Verification failed', 403
-            return 'Invalid verification request', 400
-
-        @app.route('/webhook', methods=['POST'])
-        def webhook():
-            """Handle incoming webhook messages"""
-            try:
-                if request.is_json:
-                    data = request.get_json()
-                    logging.info(f"Received webhook data: {json.dumps(data, indent=2)}")
-                    
-                    if 'entry' in data and data['entry']:
-                        entry = data['entry'][0]
-                        if 'changes' in entry and entry['changes']:
-                            change = entry['changes'][0]
-                            if 'value' in change and 'messages' in change['value']:
-                                message = change['value']['messages'][0]
-                                from_number = message['from']
-                                message_text = message['text']['body']
-                                logging.info(f"Processing message: {message_text} from {from_number}")
-                                self.handle_incoming_message(message_text, from_number)
-                    return 'OK', 200
-                else:
-                    logging.warning("Received non-JSON webhook data")
-                    return 'Invalid format', 400
-            except Exception as e:
-                logging.error(f"Error processing webhook: {e}")
-                return 'Error processing webhook', 500
+    async def _webhook_get(self, request):
+        """Handle webhook verification from WhatsApp"""
+        mode = request.query.get('hub.mode')
+        token = request.query.get('hub.verify_token')
+        challenge = request.query.get('hub.challenge')
+
+        logging.info("Received verification request - Mode: %s, Token: %s", mode, token)
+
+        if mode and token:
+            if mode == 'subscribe' and token == self.webhook_verify_token:
+                logging.info("Webhook verified successfully!")
+                return web.Response(text=challenge, status=200)
+            else:
+                logging.warning("Webhook verification failed")
+                return web.Response(text='Verification failed', status=403)
+        return web.Response(text='Invalid verification request', status=400)
 
-        # Start the Flask app
+    async def _webhook_post(self, request):
+        """Handle incoming webhook messages"""
+        try:
+            if request.content_type == 'application/json':
+                data = orjson.loads(await request.read())
+                # Pretty-printing the payload is the expensive part, skip it when INFO is filtered
+                if logging.getLogger().isEnabledFor(logging.INFO):
+                    logging.info("Received webhook data: %s", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode())
+                
+                if 'entry' in data and data['entry']:
+                    entry = data['entry'][0]
+                    if 'changes' in entry and entry['changes']:
+                        change = entry['changes'][0]
+                        if 'value' in change and 'messages' in change['value']:
+                            message = change['value']['messages'][0]
+                            from_number = message['from']
+                            message_text = message['text']['body']
+                            logging.info("Processing message: %s from %s", message_text, from_number)
+                            # Acknowledge straight away, WhatsApp redelivers webhooks that are slow to answer
+                            task = asyncio.create_task(self.handle_incoming_message(message_text, from_number))
+                            self._webhook_tasks.add(task)
+                            task.add_done_callback(self._webhook_task_done)
+                return web.Response(text='OK', status=200)
+            else:
+                logging.warning("Received non-JSON webhook data")
+                return web.Response(text='Invalid format', status=400)
+        except Exception as e:
+            logging.error("Error processing webhook: %s", e)
+            return web.Response(text='Error processing webhook', status=500)
+
+    def _webhook_task_done(self, task):
+        """Forget a finished webhook command and log it if it failed"""
+        self._webhook_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logging.error("Error handling incoming message: %s", task.exception())
+
+    async def _webhook_loop(self):
+        """Serve the aiohttp webhook on the running event loop until cancelled"""
+        app = web.Application()
+        app.router.add_get('/webhook', self._webhook_get)
+        app.router.add_post('/webhook', self._webhook_post)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
         port = int(os.environ.get('WEBHOOK_PORT', '3000'))
-        logging.info(f"Starting webhook server on port {port}")
-        app.run(host='0.0.0.0', port=port)
+        logging.info("Starting webhook server on port %s", port)
+        site = web.TCPSite(runner, '0.0.0.0', port)
+        try:
+            await site.start()
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
 
-    def handle_incoming_message(self, message_text, from_number):
+    async def handle_incoming_message(self, message_text, from_number):
         """Handle incoming WhatsApp messages"""
         # Check if the number belongs to one of our players
-        if from_number not in self.phone_to_player:
-            logging.warning(f"Received message from unknown number: {from_number}")
+        player_name = self.phone_to_player.get(from_number)
+        if player_name is None:
+            logging.warning("Received message from unknown number: %s", from_number)
             return
             
-        player_name = self.phone_to_player[from_number]
-        logging.info(f"Processing command from {player_name}: {message_text}")
+        logging.info("Processing command from %s: %s", player_name, message_text)
         
-        if message_text.lower().startswith('!gameid '):
-            new_game_id = message_text.split(' ')[1].strip()
-            if self.validate_game_id(new_game_id):
+        command, sep, argument = message_text.partition(' ')
+        new_game_id = argument.strip()
+        if command.lower() == '!gameid' and sep and new_game_id:
+            if await self.validate_game_id(new_game_id):
                 old_game_id = self.game_id
                 self.game_id = new_game_id
                 
+                # Reset current state before any await, so the poller can't mix the two games
+                self.current_state = None
+                self.game_age = 0
+                self.undo_count = 0
+                self._etag = None
+                self._spectator_id = None
+                
                 # Notify all players of the change
                 update_message = (
                     f"🎲 Game ID updated by {player_name}\n"
@@ -119,29 +186,209 @@ class TerraformingMarsMonitor:
                     f"New game: {new_game_id}"
                 )
                 
-                for phone in self.player_phones.values():
-                    if phone:
-                        self.send_whatsapp_message(phone, update_message)
-                
-                # Reset current state
-                self.current_state = None
-                logging.info(f"Game ID updated to {new_game_id} by {player_name}")
+                await self.broadcast(update_message)
+                logging.info("Game ID updated to %s by %s", new_game_id, player_name)
             else:
-                self.send_whatsapp_message(
+                await self.send_whatsapp_message(
                     from_number,
                     f"❌ Invalid game ID: {new_game_id}\n"
                     "Make sure the game exists and the ID is correct"
+                )
+
+    @staticmethod
+    def _retry_after(response):
+        """Seconds to wait according to a Retry-After header, if there is one"""
+        value = response.headers.get('Retry-After')
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    async def _request(self, client, method, url, retries=5, backoff_factor=0.5, idempotent=True, **kwargs):
+        """Send a request, retrying connection errors, rate limits and server errors with backoff"""
+        # Non-idempotent requests (WhatsApp sends) are only retried when they provably never
+        # reached the server, or it refused them with 429 and a Retry-After, so nothing is sent twice
+        if idempotent:
+            retry_errors = httpx.TransportError
+        else:
+            retry_errors = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+        for attempt in range(retries + 1):
+            delay = min(backoff_factor * (2 ** attempt), self.max_retry_delay)
+            try:
+                response = await client.request(method, url, **kwargs)
+            except retry_errors:
+                if attempt == retries:
+                    raise
+            else:
+                if attempt == retries:
+                    return response
+                retry_after = self._retry_after(response)
+                if idempotent:
+                    if response.status_code not in (429, 500, 502, 503, 504):
+                        return response
+                elif response.status_code != 429 or retry_after is None:
+                    return response
+                if retry_after is not None:
+                    delay = min(retry_after, self.max_retry_delay)
+                logging.warning("%s %s returned %s, retrying in %.1fs", method, url, response.status_code, delay)
+            await asyncio.sleep(delay)
 
-    def run(self):
-        """Main monitoring loop"""
+    async def validate_game_id(self, game_id):
+        """Check that a game exists on the server, caching successes for validation_ttl seconds"""
+        now = time.monotonic()
+        if self._valid_games.get(game_id, 0) > now:
+            return True
+        try:
+            response = await self._request(self.game_client, 'GET', '/api/game', params={'id': game_id})
+            if response.status_code != 200:
+                return False
+            self._valid_games = {gid: expiry for gid, expiry in self._valid_games.items() if expiry > now}
+            self._valid_games[game_id] = now + self.validation_ttl
+            return True
+        except httpx.HTTPError as e:
+            logging.error("Error validating game ID %s: %s", game_id, e)
+            return False
+
+    async def get_game_state(self):
+        """Fetch the current game state from the server, or None if it has not changed"""
+        game_id = self.game_id
+        headers = {'If-None-Match': self._etag} if self._etag else {}
+        response = await self._request(self.game_client, 'GET', '/api/game', params={'id': game_id}, headers=headers)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        if game_id == self.game_id:
+            self._etag = response.headers.get('ETag')
+        return response.json()
+
+    async def check_waiting_for(self):
+        """Ask the server whether the game has moved past our last seen gameAge"""
+        params = {
+            'id': self._spectator_id,
+            'gameAge': self.game_age,
+            'undoCount': self.undo_count
+        }
+        response = await self._request(self.game_client, 'GET', '/api/waitingfor', params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def _game_may_have_changed(self):
+        """Return False only when /api/waitingfor says there is nothing new"""
+        if not self._spectator_id:
+            return True
+        try:
+            waiting_for = await self.check_waiting_for()
+        except httpx.HTTPError as e:
+            # Fall back to polling /api/game directly
+            logging.warning("Could not check waitingfor, fetching game state instead: %s", e)
+            return True
+        return waiting_for.get('result') != 'WAIT'
+
+    @staticmethod
+    def _color_map(players):
+        """Build a color -> player name lookup"""
+        return {player.get('color'): player.get('name') for player in players}
+
+    def queue_broadcast(self, message):
+        """Queue a message for every player until the next flush"""
+        for phone in self._active_phones:
+            self._pending.setdefault(phone, {})[message] = None
+
+    async def _flusher(self, interval=0.5):
+        """Send queued notifications every interval, one message per phone"""
+        while True:
+            await asyncio.sleep(interval)
+            if not self._pending:
+                continue
+            pending, self._pending = self._pending, {}
+            await asyncio.gather(
+                *(self.send_whatsapp_message(phone, "\n".join(messages)) for phone, messages in pending.items()),
+                return_exceptions=True
+            )
+
+    async def notify_players(self, game_state):
+        """Send notifications when the phase or active player changes"""
+        if not game_state:
+            return
+
+        phase = game_state.get('phase')
+        active_color = game_state.get('activePlayer')
+        active_player_name = self._color_map(game_state.get('players', [])).get(active_color)
+
+        # Only keep the fields we compare on, not the whole game JSON
+        if self.current_state is None:
+            self.current_state = (phase, active_color)
+            return
+        prev_phase, prev_active = self.current_state
+        self.current_state = (phase, active_color)
+
+        if phase != prev_phase:
+            self.queue_broadcast(f"🔄 Game phase changed to: {phase}")
+
+        if active_color != prev_active and active_player_name:
+            self.queue_broadcast(f"🎯 It's {active_player_name}'s turn!")
+
+    async def send_whatsapp_message(self, phone_number, message):
+        """Send a WhatsApp text message to a single recipient"""
+        body = orjson.dumps({
+            "messaging_product": "whatsapp",
+            "to": phone_number,
+            "type": "text",
+            "text": {"body": message}
+        })
+
+        try:
+            response = await self._request(self.wa_client, 'POST', self._wa_path, idempotent=False, content=body)
+            if response.status_code == 200:
+                logging.info("Message sent successfully to %s: %s", phone_number, message)
+                return True
+            logging.error("Failed to send message to %s: %s", phone_number, response.text)
+        except httpx.HTTPError as e:
+            logging.error("Error sending message to %s: %s", phone_number, e)
+        return False
+
+    async def broadcast(self, message):
+        """Send a message to every player in parallel"""
+        await asyncio.gather(
+            *(self.send_whatsapp_message(phone, message) for phone in self._active_phones),
+            return_exceptions=True
+        )
+
+    async def _poll_loop(self):
+        """Watch the game and queue notifications as it changes"""
+        while True:
+            try:
+                game_id = self.game_id
+                game_state = await self.get_game_state() if await self._game_may_have_changed() else None
+                # A !gameid change while we were waiting makes this answer stale, drop it
+                if game_id != self.game_id:
+                    game_state = None
+                # None also covers a 304 from /api/game, which still waits out the poll interval below
+                if game_state is not None:
+                    self.game_age = game_state.get('gameAge', self.game_age)
+                    self.undo_count = game_state.get('undoCount', self.undo_count)
+                    self._spectator_id = game_state.get('spectatorId', self._spectator_id)
+                    await self.notify_players(game_state)
+                # Don't hold the full game JSON through the sleep below
+                del game_state
+                
+            except Exception as e:
+                logging.error("Error in monitor loop: %s", e)
+            
+            # waitingfor answers immediately, so keep a minimum gap between polls
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(self):
+        """Run the poller, webhook server and notification flusher on one event loop"""
         logging.info("Starting Terraforming Mars game monitor...")
-        logging.info(f"Monitoring game ID: {self.game_id}")
-        
-        # Start webhook server in a separate thread
-        import threading
-        webhook_thread = threading.Thread(target=self.setup_webhook_server)
-        webhook_thread.daemon = True
-        webhook_thread.start()
+        logging.info("Monitoring game ID: %s", self.game_id)
         
         # Send startup message with instructions
         startup_message = (
@@ -149,20 +396,14 @@ class TerraformingMarsMonitor:
             f"Current game ID: {self.game_id}\n"
             "Send '!gameid <new-id>' to update the game"
         )
-        for phone in self.player_phones.values():
-            if phone:
-                self.send_whatsapp_message(phone, startup_message)
         
-        while True:
-            try:
-                game_state = self.get_game_state()
-                self.notify_players(game_state)
-                time.sleep(5)
-                
-            except Exception as e:
-                logging.error(f"Error in monitor loop: {e}")
-                time.sleep(5)
+        try:
+            await self.broadcast(startup_message)
+            await asyncio.gather(self._poll_loop(), self._webhook_loop(), self._flusher())
+        finally:
+            await self.wa_client.aclose()
+            await self.game_client.aclose()
 
 if __name__ == "__main__":
     monitor = TerraformingMarsMonitor()
-    monitor.run()
\ No newline at end of file
+    asyncio.run(monitor.run())
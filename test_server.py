@@ -6,9 +6,9 @@ app = Flask(__name__)
 
 @app.route('/', methods=['GET', 'POST'])
 def test():
-    logging.info(f"Received {request.method} request")
-    logging.info(f"Headers: {dict(request.headers)}")
-    logging.info(f"Data: {request.get_data()}")
+    logging.info("Received %s request", request.method)
+    logging.info("Headers: %s", dict(request.headers))
+    logging.info("Data: %s", request.get_data())
     return "Server is running!", 200
 
 if __name__ == "__main__":